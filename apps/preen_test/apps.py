@@ -2,4 +2,9 @@ from django.apps import AppConfig
 
 
 class Preentest(AppConfig):
-    name = "preen_test"
+    name = "apps.preen_test"
+
+    def ready(self):
+        from apps.preen_test.signals import register_signal_handlers
+
+        register_signal_handlers()
@@ -15,12 +15,16 @@ class HeadingColorValues(TextChoices):
     DARK = "dark"
 
 
+_HEADING_SIZE_CHOICES = tuple(HeadingSizeChoices.choices)
+_HEADING_COLOR_CHOICES = tuple(HeadingColorValues.choices)
+
+
 class HeadingBaseBlock(blocks.StructBlock):
     """
     Provides basics for Heading text
     """
-    size = blocks.ChoiceBlock(choices=HeadingSizeChoices.choices)
-    color_value = blocks.ChoiceBlock(choices=HeadingColorValues.choices)
+    size = blocks.ChoiceBlock(choices=_HEADING_SIZE_CHOICES)
+    color_value = blocks.ChoiceBlock(choices=_HEADING_COLOR_CHOICES)
 
 
 class HeadingBlock(HeadingBaseBlock):
@@ -1,66 +1,138 @@
-from collections import OrderedDict
+import hashlib
+import json
+import re
+import uuid
 
-from decimal import Decimal
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.forms.utils import ErrorList
 
 from wagtail.core import blocks
 from wagtail.core.blocks import PageChooserBlock
+from wagtail.core.blocks.struct_block import StructBlockValidationError
 from wagtail.documents.blocks import DocumentChooserBlock
 from wagtail.images.blocks import ImageChooserBlock
 
-from collections import deque
-from html.parser import HTMLParser
-
 from django.core.exceptions import ValidationError
 from django.db.models import TextChoices
 from django.forms.utils import ErrorList
-from django.template.defaultfilters import pluralize
-
-LETTERBOX_RATIO = Decimal(9 / 16)
-RICHTEXT_SUBHEADING_FEATURES = ["bold", "italic", "ol", "ul", "link", "document_link"]
-
-class ProperTagOrderParser(HTMLParser):
-    """ An HTML parser that ensures tags are properly closed. """
 
-    def __init__(self):
-        super().__init__()
-        self.tag_stack = deque()
-
-    def handle_starttag(self, tag, attrs):
-        self.tag_stack.append(tag)
-
-    def handle_endtag(self, tag):
-        expected_tag = self.tag_stack.pop()
+LETTERBOX_RATIO = 9 / 16
+RICHTEXT_SUBHEADING_FEATURES = ("bold", "italic", "ol", "ul", "link", "document_link")
+RICHTEXT_COPY_FEATURES = ("bold", "italic", "h2", "h3", "h4", "ol", "ul", "link", "document-link")
+
+# Link validation messages are constant, so their errors are built once and shared.
+_ERR_ONLY_ONE = ValidationError("Only one link type may be specified.")
+_ERR_ONE_REQUIRED = ValidationError("One link type must be provided.")
+_ERR_EXTERNAL_NEEDS_TEXT = ValidationError("Display text is required if using an external link")
+_ERR_EXACTLY_ONE = ValidationError("Must provide exactly one link type")
+
+# Attributes must start with whitespace or "/", so they cannot overlap the tag name, and
+# unquoted attribute text stops at "<". Together these keep a "<" that is never closed
+# from scanning on to the end of the input, which would make check_tag_order quadratic.
+_ATTRS_PATTERN = r"""(?:[\s/](?:"[^"]*"|'[^']*'|[^'"<>])*)?"""
+
+# Matches, in order: a comment (an unterminated one runs to the end of the input); a
+# closing tag, whose name may follow "</" after whitespace only if nothing but
+# whitespace follows it; any other "</", which HTMLParser ignores up to the next ">" (or
+# the rest of the input, if there is none); or an opening or self-closing tag. As with
+# HTMLParser, an opening tag's name must follow "<" immediately, so "<" on its own is
+# text, and ">" inside a quoted attribute does not end the tag.
+#
+# Each tag name is followed by a lookahead that forbids stopping part way through it,
+# so a tag that fails to match does not backtrack through its name.
+_TAG_RE = re.compile(
+    r"<!--.*?(?:-->|\Z)"
+    r"|</\s*(?P<end_tag>[a-zA-Z][-.a-zA-Z0-9:_]*)\s*>"
+    r"|</(?P<loose_end_tag>[a-zA-Z][^\s/>]*)(?![^\s/>])[^>]*>"
+    r"|</[^>]*(?:>|\Z)"
+    rf"|<(?P<tag>[a-zA-Z][^\s/<>]*)(?![^\s/<>])(?P<attrs>{_ATTRS_PATTERN})>",
+    re.DOTALL,
+)
+# The contents of script and style elements hold no tags to check, so scanning skips
+# straight to their closing tag.
+_RAW_TEXT_END_RES = {tag: re.compile(rf"</\s*{tag}\s*>", re.IGNORECASE) for tag in ("script", "style")}
+# A trailing "/" that belongs to an unquoted attribute value, as in <a href=/path/>,
+# rather than marking the tag as self-closing.
+_UNQUOTED_SLASH_RE = re.compile(r"""=\s*[^\s"'=]*/$""")
+# Elements that never take a closing tag.
+_VOID_TAGS = frozenset(
+    ("area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr")
+)
+
+
+def check_tag_order(html):
+    """
+    Ensure that the tags in `html` are properly closed. Raises ValueError for a mismatched
+    or unclosed tag, and IndexError for a closing tag that was never opened.
+    """
+    tag_stack = []
+    position = 0
+    while True:
+        match = _TAG_RE.search(html, position)
+        if match is None:
+            break
+        position = match.end()
+
+        tag = match.group("tag")
+        if tag is not None:
+            tag = tag.lower()
+            attrs = match.group("attrs")
+            self_closing = attrs.endswith("/") and not _UNQUOTED_SLASH_RE.search(attrs)
+            if tag in _VOID_TAGS or self_closing:
+                continue
+            if tag in _RAW_TEXT_END_RES:
+                raw_text_end = _RAW_TEXT_END_RES[tag].search(html, position)
+                if raw_text_end is not None:
+                    position = raw_text_end.end()
+                    continue
+                # An unterminated script/style element is left open, as HTMLParser leaves it.
+                tag_stack.append(tag)
+                break
+            tag_stack.append(tag)
+            continue
+
+        tag = match.group("end_tag") or match.group("loose_end_tag")
+        if tag is None:
+            continue
+        tag = tag.lower()
+        if tag in _VOID_TAGS:
+            continue
+
+        expected_tag = tag_stack.pop()
         if tag != expected_tag:
-            line, offset = self.getpos()
+            start = match.start()
+            line = html.count("\n", 0, start) + 1
+            offset = start - html.rfind("\n", 0, start) - 1
             raise ValueError(
                 'Unexpected closing tag on line {} ({} offset): got "{}", expected "{}"'.format(
                     line, offset, tag, expected_tag
                 )
             )
 
-    def close(self):
-        if len(self.tag_stack) == 0:
-            return
-        raise ValueError(
-            "Tag{} not closed: {}".format(pluralize(len(self.tag_stack), " was,s were"), ", ".join(self.tag_stack))
-        )
+    if tag_stack:
+        suffix = " was" if len(tag_stack) == 1 else "s were"
+        raise ValueError(f"Tag{suffix} not closed: {', '.join(tag_stack)}")
+
+
+def html_field_errors(fields, *field_names):
+    """ Check RawHTMLBlock fields for proper HTML, returning an ErrorList for each field that fails. """
+    field_details = {}
+    for field_name in field_names:
+        try:
+            check_tag_order(fields.get(field_name) or "")
+        except ValueError as error:
+            field_details[field_name] = ErrorList([ValidationError(str(error))])
+        except IndexError:
+            field_details[field_name] = ErrorList([ValidationError("Encountered closed tag before it was opened")])
+    return field_details
 
-def clean_html_field(fields, field_name):
-    """ Validate a RawHTMLBlock field, ensuring that it is proper HTML. """
-    try:
-        parser = ProperTagOrderParser()
-        parser.feed(fields.get(field_name))
-        parser.close()
-    except ValueError as error:
-        field_details = {}
-        field_details[field_name] = ErrorList([ValidationError(error)])
-        raise ValidationError("Code validation error", params=field_details)
-    except IndexError:
-        field_details = {}
-        field_details[field_name] = ErrorList([ValidationError("Encountered closed tag before it was opened")])
-        raise ValidationError("Code validation error", params=field_details)
+
+def clean_html_fields(fields, *field_names):
+    """ Validate RawHTMLBlock fields, ensuring that each one is proper HTML. """
+    field_details = html_field_errors(fields, *field_names)
+    if field_details:
+        raise StructBlockValidationError(field_details)
 
 
 # # # # # # # # # # # # #
@@ -68,6 +140,59 @@ def clean_html_field(fields, field_name):
 # # # # # # # # # # # # #
 
 
+# Part of every render cache key; replacing it invalidates every cached render at once.
+_RENDER_CACHE_VERSION_KEY = "block:render-version"
+
+
+def _render_cache_version():
+    return cache.get_or_set(_RENDER_CACHE_VERSION_KEY, lambda: uuid.uuid4().hex, timeout=None)
+
+
+def clear_block_render_cache(**kwargs):
+    """
+    Invalidate every render cached by CachedRenderMixin. Connected to changes to pages,
+    images and documents (see apps.preen_test.signals), since cached output holds their
+    URLs and titles.
+    """
+    cache.set(_RENDER_CACHE_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+class CachedRenderMixin:
+    """
+    Caches a block's rendered HTML for `Meta.cache_timeout` seconds. The cache key covers
+    the block class, its template, its value and any context variables the template reads,
+    which must be listed in `Meta.cache_context_keys`. Previews always render fresh, and
+    clear_block_render_cache empties the cache when content it may show changes.
+
+    Only mix this into blocks whose template, and the templates of any child blocks it
+    renders, depend on nothing outside those (no forms, CSRF tokens or per-request state).
+    """
+
+    def get_render_cache_key(self, value, context=None):
+        block_class = type(self)
+        context_keys = getattr(self.meta, "cache_context_keys", ())
+        context_values = {key: context.get(key) for key in context_keys} if context else {}
+        # The API representation leaves out list item ids, which are regenerated for
+        # values that were stored without them.
+        data = json.dumps(
+            [self.meta.template, self.get_api_representation(value), context_values], sort_keys=True, default=str
+        )
+        digest = hashlib.blake2b(data.encode(), digest_size=16).hexdigest()
+        return f"block:{_render_cache_version()}:{block_class.__module__}.{block_class.__qualname__}:{digest}"
+
+    def render(self, value, context=None):
+        request = context.get("request") if context else None
+        if getattr(request, "is_preview", False):
+            return super().render(value, context=context)
+
+        key = self.get_render_cache_key(value, context=context)
+        html = cache.get(key)
+        if html is None:
+            html = super().render(value, context=context)
+            cache.set(key, html, timeout=getattr(self.meta, "cache_timeout", 300))
+        return html
+
+
 class CopyBlock(blocks.StructBlock):
     """
     A shortcut for the common pattern of "Heading + Body" where:
@@ -76,19 +201,26 @@ class CopyBlock(blocks.StructBlock):
     """
 
     heading = blocks.CharBlock()
-    body = blocks.RichTextBlock(
-        features=[
-            "bold",
-            "italic",
-            "h2",
-            "h3",
-            "h4",
-            "ol",
-            "ul",
-            "link",
-            "document-link",
-        ]
-    )
+    body = blocks.RichTextBlock(features=list(RICHTEXT_COPY_FEATURES))
+
+
+class LinkValue(blocks.StructValue):
+    """
+    The value of a link block, exposing whichever of its link types was provided
+    as a single URL so templates need not check each one in turn. An external link
+    wins over an internal one, which wins over a document, as in the CTA button and
+    link tile templates.
+    """
+
+    @property
+    def resolved_link(self):
+        internal_link = self.get("internal_link")
+        document_link = self.get("document_link")
+        return (
+            self.get("external_link")
+            or (internal_link.url if internal_link else None)
+            or (document_link.url if document_link else None)
+        )
 
 
 class MultiLinkBlockBase(blocks.StructBlock):
@@ -97,26 +229,23 @@ class MultiLinkBlockBase(blocks.StructBlock):
     links.
     """
 
-    def __init__(self, **kwargs):
-        super().__init__()
-        self._required = kwargs.get("required", False)
+    # Shadow the read-only `required` property of wagtail Block, which always
+    # returns False, so that each instance can store its own value.
+    required = False
+
+    def __init__(self, required=False, **kwargs):
+        super().__init__(**kwargs)
+        self.required = required
 
     internal_link = blocks.PageChooserBlock(required=False, help_text="Internal page")
     document_link = DocumentChooserBlock(required=False, help_text="Choose a document")
     external_link = blocks.URLBlock(required=False, help_text="External URL")
 
-    @property
-    def link_types(self):
-        """
-        Register link fields on subclasses for proper validation
-        """
-        return ["internal_link", "document_link", "external_link"]
+    # Register link fields on subclasses for proper validation
+    link_types = ("internal_link", "document_link", "external_link")
 
-    # Override base required property of wagtail Block, which currently always
-    # returns False.
-    @property
-    def required(self):
-        return self._required
+    class Meta:
+        value_class = LinkValue
 
 
 class LinkBlockBase(MultiLinkBlockBase):
@@ -133,34 +262,31 @@ class LinkBlockBase(MultiLinkBlockBase):
             if the provided link is external, display text is provided
         """
         value = super().clean(value)
-        errors = {}
-        error = None
-
-        links_present = [l for l in self.link_types if value.get(l)]
+        external_link = value.get("external_link")
         display_text = value.get("display_text")
 
         # If there is no display text, and this block is not marked required,
         # no links are needed. But one is needed if there is display_text,
         # or if this block is required.
         min_links = 1 if display_text or self.required else 0
-        link_count = len(links_present)
+        link_count = sum(bool(value.get(key)) for key in self.link_types)
 
         # If more than one link type was provided, deliver an error to
         # each one specified. Otherwise, if one is needed but none
         # provided, deliver an error to every single field where the
         # the link could have been provided.
+        errors = None
         if link_count > 1:
-            error = ValidationError("Only one link type may be specified.")
-            errors = {key: ErrorList(error) for key in links_present}
+            error_list = ErrorList([_ERR_ONLY_ONE])
+            errors = dict.fromkeys((key for key in self.link_types if value.get(key)), error_list)
         elif link_count < min_links:
-            error = ValidationError("One link type must be provided.")
-            errors = {key: ErrorList(error) for key in self.link_types}
+            error_list = ErrorList([_ERR_ONE_REQUIRED])
+            errors = dict.fromkeys(self.link_types, error_list)
 
         # If user selects "external_link", display_text must be provided
-        if value.get("external_link") and not display_text:
-            errors.update(
-                {"display_text": ErrorList([ValidationError("Display text is required if using an external link")])}
-            )
+        if external_link and not display_text:
+            errors = errors or {}
+            errors["display_text"] = ErrorList([_ERR_EXTERNAL_NEEDS_TEXT])
 
         if errors:
             raise ValidationError("Link block validation error", params=errors)
@@ -173,15 +299,16 @@ class LinkBlockBase(MultiLinkBlockBase):
 class LinkWithoutTextBase(MultiLinkBlockBase):
     def clean(self, value):
         value = super().clean(value)
-        errors = {}
-
-        link_values = [k for k, v in value.items() if k in self.link_types and v]
-        if len(link_values) != 1:
-            for link_type in self.link_types:
-                errors[link_type] = ErrorList([ValidationError("Must provide exactly one link type")])
-
-        if errors:
-            raise ValidationError("Link block validation error", params=errors)
+        # Only "exactly one" matters, so stop counting at the second link.
+        link_count = 0
+        for link_type in self.link_types:
+            if value.get(link_type):
+                link_count += 1
+                if link_count > 1:
+                    break
+        if link_count != 1:
+            error_list = ErrorList([_ERR_EXACTLY_ONE])
+            raise ValidationError("Link block validation error", params=dict.fromkeys(self.link_types, error_list))
 
         return value
 
@@ -201,62 +328,87 @@ class CTAButtonList(blocks.StreamBlock):
         template = "blocks/cta_button_list_block.html"
 
 
-class ReorderableStructBlock(blocks.StructBlock):
-    class Meta:
-        field_order = None
+def _apply_field_order(child_blocks, field_order, class_name):
+    """
+    Move the fields named in field_order to the front of the child_blocks OrderedDict, in
+    that order. Any fields that do not appear in field_order keep their relative order after.
+    """
+    if not child_blocks.keys() >= set(field_order):
+        field = next(field for field in field_order if field not in child_blocks)
+        raise ValueError(
+            f"Unknown field \"{field}\" found in {class_name}.meta.fields. Accepted values are {', '.join(child_blocks)}"
+        )
 
-    def _set_child_blocks_from_field_order(self):
-        """
-        If subclass defines self.meta.field_order, take whichever valid fields appear in that list
-        and place them at the front of self.child_blocks OrderedDict. Any fields that do not appear
-        in self.meta.field_order will be appended after in the order they are defined.
-        """
-        class_name = self.__class__.__name__
-        if not self.meta.field_order:
-            return
-
-        for field in self.meta.field_order:
-            if field not in self.child_blocks:
-                raise ValueError(
-                    f"Unknown field \"{field}\" found in {class_name}.meta.fields. Accepted values are {', '.join([k for k,v in self.child_blocks.items()])}"
-                )
+    # Nothing to do when the fields are already in that order.
+    if all(field == block_name for field, block_name in zip(field_order, child_blocks)):
+        return
 
-        # Create OrderedDict out of fields declared by self.meta.field_order
-        reordered_child_blocks = OrderedDict((k, self.child_blocks[k]) for k in self.meta.field_order)
+    # Move each listed field to the front, last one first.
+    for field in reversed(field_order):
+        child_blocks.move_to_end(field, last=False)
 
-        # Every child_block...
-        for name, block in self.child_blocks.items():
-            # ... that has not been ordered by self.meta.field_order ...
-            if name not in reordered_child_blocks:
-                # ... append to OrderedDict in the order provided.
-                reordered_child_blocks[name] = block
 
-        # Override self.child_blocks with re-ordered OrderedDict
-        self.child_blocks = reordered_child_blocks
+class ReorderableStructBlockMeta(blocks.DeclarativeSubBlocksMetaclass):
+    """
+    If a block's Meta defines field_order, take whichever valid fields appear in that list
+    and place them at the front of the class's base_blocks OrderedDict. Any fields that do not
+    appear in field_order will be appended after in the order they are defined.
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self._set_child_blocks_from_field_order()
+    This runs once per class, so instances simply copy the already-ordered base_blocks.
+    Meta.field_order may therefore only name declared fields; an unknown field raises
+    ValueError when the class is defined.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super().__init__(name, bases, attrs)
+        field_order = getattr(cls._meta_class, "field_order", None)
+        if field_order:
+            # base_blocks is built fresh for every class, so it can be reordered in place.
+            _apply_field_order(cls.base_blocks, field_order, name)
+
+
+class ReorderableStructBlock(blocks.StructBlock, metaclass=ReorderableStructBlockMeta):
+    """
+    Blocks passed as local_blocks are appended after the ordered fields. To place them
+    elsewhere, pass a field_order naming them to the constructor as well.
+    """
+
+    class Meta:
+        field_order = None
+
+    def __init__(self, local_blocks=None, **kwargs):
+        super().__init__(local_blocks, **kwargs)
+        # The declared fields were ordered with the class; only an instance's own blocks
+        # or field_order need applying here.
+        if self.meta.field_order and (local_blocks or "field_order" in kwargs):
+            _apply_field_order(self.child_blocks, self.meta.field_order, type(self).__name__)
 
 
-class VideoIframeBlockBase(blocks.StructBlock):
+class VideoIframeBlockBase:
     """
     These videos are provided as iframes which handle all their own functionality.
     Because iframes are a black box, there is little to no validation we can perform
     on the code provided, except that it is valid html.
-    """
 
-    video_code = blocks.RawHTMLBlock(
-        required=False,
-        help_text=("Paste in your video iframe here"),
-    )
+    A plain mixin rather than a StructBlock, so it adds no extra step to the block's
+    MRO: concrete blocks declare a `video_code` RawHTMLBlock and list this mixin
+    before their StructBlock base.
+    """
 
     def clean(self, value):
-        values = super().clean(value)
+        # Check the embed up front so its errors are attached to video_code and
+        # reported together with those of the other fields.
+        video_errors = html_field_errors(value, "video_code")
+        try:
+            values = super().clean(value)
+        except StructBlockValidationError as error:
+            raise StructBlockValidationError({**video_errors, **error.block_errors})
+        if video_errors:
+            raise StructBlockValidationError(video_errors)
         return values
 
 
-class SideBarLink(blocks.StructBlock):
+class SideBarLink(CachedRenderMixin, blocks.StructBlock):
     """
     Displays as a list of links with a descriptive title.
     """
@@ -268,6 +420,7 @@ class SideBarLink(blocks.StructBlock):
         icon = "link"
         admin_text = "A series of links either internal or external"
         template = "blocks/sidebar_link_block.html"
+        cache_timeout = 300
 
 
 class SimpleLinkWImageBlock(blocks.StructBlock):
@@ -304,9 +457,13 @@ class BaseContactFormChooser(blocks.StructBlock):
 
 class FullHeroBlock(VideoIframeBlockBase, ReorderableStructBlock):
     image = ImageChooserBlock(required=True)
+    video_code = blocks.RawHTMLBlock(
+        required=False,
+        help_text=("Paste in your video iframe here"),
+    )
     heading = blocks.CharBlock(required=True)
     heading_as_h1 = blocks.BooleanBlock(default=True, required=False)
-    sub_heading = blocks.RichTextBlock(required=False, features=RICHTEXT_SUBHEADING_FEATURES)
+    sub_heading = blocks.RichTextBlock(required=False, features=list(RICHTEXT_SUBHEADING_FEATURES))
 
     cta_buttons = CTAButtonList(required=False)
 
@@ -316,7 +473,7 @@ class FullHeroBlock(VideoIframeBlockBase, ReorderableStructBlock):
         field_order = ["image", "video_code"]
 
 
-class LinkTile(blocks.StructBlock):
+class LinkTile(CachedRenderMixin, blocks.StructBlock):
     """
     A block with an image header a linkable title and description that renders as a card.
     """
@@ -329,6 +486,7 @@ class LinkTile(blocks.StructBlock):
     class Meta:
         icon = "fa-th-large"
         template = "blocks/link_tile_block.html"
+        cache_timeout = 300
 
 
 class ColumnatedLinksBlock(blocks.StructBlock):
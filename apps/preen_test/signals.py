@@ -0,0 +1,21 @@
+from django.db.models.signals import post_delete, post_save
+
+from wagtail.core.signals import page_published, page_unpublished, post_page_move
+from wagtail.documents import get_document_model
+from wagtail.images import get_image_model
+
+from apps.preen_test.blocks.blocks import clear_block_render_cache
+
+
+def register_signal_handlers():
+    """
+    Clear cached block renders when a page is published, unpublished or moved, or an
+    image or document is saved or deleted. Rendered blocks embed page URLs, image
+    rendition URLs and document titles, none of which are part of the cache key.
+    """
+    dispatch_uid = "preen_test.clear_block_render_cache"
+    for signal in (page_published, page_unpublished, post_page_move):
+        signal.connect(clear_block_render_cache, dispatch_uid=dispatch_uid)
+    for model in (get_image_model(), get_document_model()):
+        post_save.connect(clear_block_render_cache, sender=model, dispatch_uid=dispatch_uid)
+        post_delete.connect(clear_block_render_cache, sender=model, dispatch_uid=dispatch_uid)
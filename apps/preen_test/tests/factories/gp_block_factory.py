@@ -1,29 +1,58 @@
 from faker import Faker
-from wagtail.images.tests.utils import Image, get_test_image_file
+
+from apps.preen_test.tests.factories.gp_utils import Image, get_test_image_file_png
+
+
+faker = Faker()
+SHARED_IMAGE_TITLE = "Shared test image"
 
 
 class BaseGenerator:
+    """
+    Generators declare their fields in `__slots__`. `as_dict` returns every field that has
+    been set, in slot order, starting with the fields of base generators.
+    """
+
+    __slots__ = ()
     type = None
+    _fields = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if not cls.type:
+            raise NotImplementedError(f"{cls.__name__} must provide a type.")
+        cls._fields = tuple(field for klass in reversed(cls.__mro__) for field in klass.__dict__.get("__slots__", ()))
 
     def as_dict(self):
-        return self.__dict__
+        return {field: getattr(self, field) for field in self._fields if hasattr(self, field)}
 
     def as_block(self):
-        if not self.type:
-            raise NotImplementedError("Must provide a type.")
-        return self.type, self.__dict__
+        return self.type, self.as_dict()
 
     def as_stream_data(self):
-        sd = []
-        for k, v in self.as_dict().items():
-            sd.append({"type": k, "value": v})
-        return sd
+        return [{"type": k, "value": v} for k, v in self.as_dict().items()]
 
     @staticmethod
     def short_text(chars=32):
-        faker = Faker()
         return faker.text(max_nb_chars=chars)
 
+    @staticmethod
+    def get_image(unique=False):
+        """
+        Return an Image for a generated block. Unless `unique` is set, one image row is
+        shared by every generator; it is looked up rather than memoized so it stays valid
+        after a test case rolls the database back.
+        """
+        if not unique:
+            image = Image.objects.filter(title=SHARED_IMAGE_TITLE).first()
+            if image:
+                return image
+        title = faker.text(max_nb_chars=32) if unique else SHARED_IMAGE_TITLE
+        return Image.objects.create(
+            title=title,
+            file=get_test_image_file_png(filename=f"{title}.png", colour="white"),
+        )
+
 
 class BaseBlockFactory:
     """
@@ -62,8 +91,9 @@ class BaseBlockFactory:
         if lazy:
             return raw_objects
 
+        block = self.block_class()
         for obj in raw_objects:
-            item = self.block_class().to_python(obj["value"])
+            item = block.to_python(obj["value"])
             objs.append(
                 (
                     self.generator.type,
@@ -74,20 +104,17 @@ class BaseBlockFactory:
 
 
 class BasicHeroBlockGenerator(BaseGenerator):
+    __slots__ = ("heading", "image", "use_as_h1")
     type = "hero"
 
-    def __init__(self):
-        faker = Faker()
-        fake_title = faker.text(max_nb_chars=32)
-        self.heading = faker.text(max_nb_chars=32)
-        self.image = Image.objects.create(
-            title=fake_title,
-            file=get_test_image_file(filename=f"{fake_title}.png", colour="white"),
-        )
+    def __init__(self, unique_image=False):
+        self.heading = self.short_text()
+        self.image = self.get_image(unique=unique_image)
         self.use_as_h1 = True
 
 
 class AccordionGenerator(BaseGenerator):
+    __slots__ = ("heading", "content", "embed")
     type = "accordion"
 
     def __init__(self, heading=None):
@@ -110,6 +137,7 @@ class AccordionGenerator(BaseGenerator):
 
 
 class SidebarLinkGenerator(BaseGenerator):
+    __slots__ = ("link_type", "title", "link_block")
     type = "sidebar_link"
     EXTERNAL = "external_link"
     INTERNAL = "internal_link"
@@ -135,6 +163,7 @@ class SidebarLinkGenerator(BaseGenerator):
 
 
 class CTAButtonGenerator(SidebarLinkGenerator):
+    __slots__ = ("styled_as_primary",)
     type = "cta_button"
 
     def __init__(self, primary=True):
@@ -143,6 +172,7 @@ class CTAButtonGenerator(SidebarLinkGenerator):
 
 
 class LinkBlockGenerator(BaseGenerator):
+    __slots__ = ("display_text", "internal_link", "document_link", "external_link")
     type = "link_block"
 
     def __init__(self):
@@ -153,21 +183,18 @@ class LinkBlockGenerator(BaseGenerator):
 
 
 class LinkTileGenerator(BaseGenerator):
+    __slots__ = ("title", "link_block", "image", "description")
     type = "tile"
 
-    def __init__(self):
-        fake_title = self.short_text()
+    def __init__(self, unique_image=False):
         self.title = self.short_text()
         self.link_block = LinkBlockGenerator().as_dict()
-        image = Image.objects.create(
-            title=fake_title,
-            file=get_test_image_file(filename=f"{fake_title}.png", colour="white"),
-        )
-        self.image = image.pk
+        self.image = self.get_image(unique=unique_image).pk
         self.description = self.short_text(chars=64)
 
 
 class SimpleLinkWImageGenerator(BaseGenerator):
+    __slots__ = ("display_text", "link")
     type = "simple_link"
 
     def __init__(self, display_text=None, link=False, image=None):
@@ -179,6 +206,7 @@ class SimpleLinkWImageGenerator(BaseGenerator):
 
 
 class ColumnatedLinksBlockGenerator(BaseGenerator):
+    __slots__ = ("title", "cta_button")
     type = "columnated_links"
 
     def __init__(self, title=None, cta=None):
@@ -189,6 +217,7 @@ class ColumnatedLinksBlockGenerator(BaseGenerator):
 
 
 class CopyBlockGenerator(BaseGenerator):
+    __slots__ = ("heading", "body")
     type = "copy"
 
     def __init__(self, heading="", body=""):
@@ -197,6 +226,7 @@ class CopyBlockGenerator(BaseGenerator):
 
 
 class HtmlEmbedBlockGenerator(BaseGenerator):
+    __slots__ = ("code", "caption")
     type = "html_embed"
 
     def __init__(self, code="", caption=""):
@@ -206,6 +236,7 @@ class HtmlEmbedBlockGenerator(BaseGenerator):
 
 
 class TwoColumnHtmlEmbedBlockGenerator(HtmlEmbedBlockGenerator):
+    __slots__ = ("copy", "text_on_left")
     type = "two_column_html_embed"
 
     def __init__(self, copy=None, text_on_left=None):
@@ -215,12 +246,9 @@ class TwoColumnHtmlEmbedBlockGenerator(HtmlEmbedBlockGenerator):
 
 
 class NewsletterSignupGenerator(BaseGenerator):
+    __slots__ = ("background_image", "text")
     type = "newsletter_signup"
 
-    def __init__(self):
-        fake_title = self.short_text()
-        self.background_image = Image.objects.create(
-            title=fake_title,
-            file=get_test_image_file(filename=f"{fake_title}.png", colour="white"),
-        )
+    def __init__(self, unique_image=False):
+        self.background_image = self.get_image(unique=unique_image)
         self.text = self.short_text()
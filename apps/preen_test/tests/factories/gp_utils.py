@@ -1,3 +1,4 @@
+from functools import lru_cache
 from io import BytesIO
 
 from django.core.files.images import ImageFile
@@ -26,18 +27,21 @@ class DocumentFactory(factory.django.DjangoModelFactory):
         model = Document
 
 
-def get_test_image_file_png(filename="test.png", colour="white", size=(640, 480)):
+@lru_cache(maxsize=None)
+def _encoded_test_image(colour, size, fmt):
+    """Encode a plain test image once per (colour, size, format) and reuse the bytes."""
     f = BytesIO()
     image = PIL.Image.new("RGB", size, colour)
-    image.save(f, "PNG")
-    return ImageFile(f, name=filename)
+    image.save(f, fmt)
+    return f.getvalue()
+
+
+def get_test_image_file_png(filename="test.png", colour="white", size=(640, 480)):
+    return ImageFile(BytesIO(_encoded_test_image(colour, tuple(size), "PNG")), name=filename)
 
 
 def get_test_image_file_jpeg(filename="test.jpg", colour="white", size=(640, 480)):
-    f = BytesIO()
-    image = PIL.Image.new("RGB", size, colour)
-    image.save(f, "JPEG")
-    return ImageFile(f, name=filename)
+    return ImageFile(BytesIO(_encoded_test_image(colour, tuple(size), "JPEG")), name=filename)
 
 
 def get_test_document_file():
@@ -1,2 +1,320 @@
-import pytest
+import time
+from unittest import mock
 
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.test import RequestFactory, TestCase
+
+from wagtail.core import blocks as wagtail_blocks
+from wagtail.core.blocks.struct_block import StructBlockValidationError
+from wagtail.core.models import Page
+from wagtail.core.signals import page_published
+from wagtail.documents.models import Document
+from wagtail.images.models import Image
+
+from apps.preen_test.blocks import blocks
+from apps.preen_test.signals import register_signal_handlers
+from apps.preen_test.tests.factories.gp_utils import get_test_image_file_png
+
+
+class ChooserQueryCountTest(TestCase):
+    """ Choosers nested in lists and streams are fetched with one query per model. """
+
+    def setUp(self):
+        self.documents = [Document.objects.create(title=f"Document {i}") for i in range(5)]
+
+    def link(self, document):
+        return {"internal_link": None, "document_link": document.pk, "external_link": "", "display_text": ""}
+
+    def test_sidebar_links(self):
+        block = blocks.SideBarLink()
+        with self.assertNumQueries(1):
+            value = block.to_python({"title": "Links", "links": [self.link(doc) for doc in self.documents]})
+        with self.assertNumQueries(0):
+            self.assertEqual([link["document_link"] for link in value["links"]], self.documents)
+
+    def test_cta_button_list(self):
+        block = blocks.CTAButtonList()
+        value = block.to_python([{"type": "cta_button", "value": self.link(doc)} for doc in self.documents])
+        with self.assertNumQueries(1):
+            self.assertEqual([button.value["document_link"] for button in value], self.documents)
+
+    def test_link_tiles(self):
+        block = blocks.ManualLinkTileBlock().child_blocks["tiles"]
+        tile = {"image": None, "title": "Tile", "description": "", "link": None}
+        value = block.to_python([{"type": "tile", "value": dict(tile, link=self.link(doc))} for doc in self.documents])
+        with self.assertNumQueries(1):
+            self.assertEqual([child.value["link"]["document_link"] for child in value], self.documents)
+
+
+class ContextLinkTile(blocks.LinkTile):
+    class Meta:
+        cache_context_keys = ("link_class",)
+
+
+class CachedRenderTest(TestCase):
+    """ CachedRenderMixin only reuses a render when nothing the template reads has changed. """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Normally done by the app's ready().
+        register_signal_handlers()
+
+    def setUp(self):
+        cache.clear()
+        self.value = {"title": "Links", "links": [{"external_link": "https://example.com", "display_text": "Example"}]}
+        patcher = mock.patch("wagtail.core.blocks.base.render_to_string", return_value="<p>rendered</p>")
+        self.render_to_string = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def render(self, block, value=None, context=None):
+        block = block or blocks.SideBarLink()
+        return block.render(block.to_python(value or self.value), context=context)
+
+    def test_same_value_is_cached(self):
+        block = blocks.SideBarLink()
+        self.assertEqual(self.render(block), "<p>rendered</p>")
+        self.assertEqual(self.render(block), "<p>rendered</p>")
+        self.render(blocks.SideBarLink())
+        self.assertEqual(self.render_to_string.call_count, 1)
+
+    def test_different_value_is_not_cached(self):
+        block = blocks.SideBarLink()
+        self.render(block)
+        self.render(block, dict(self.value, title="Other links"))
+        self.assertEqual(self.render_to_string.call_count, 2)
+
+    def test_instance_template_is_part_of_key(self):
+        self.render(blocks.SideBarLink())
+        self.render(blocks.SideBarLink(template="blocks/other_sidebar_link_block.html"))
+        self.assertEqual(self.render_to_string.call_count, 2)
+        self.assertEqual(self.render_to_string.call_args[0][0], "blocks/other_sidebar_link_block.html")
+
+    def test_block_class_is_part_of_key(self):
+        tile = {"image": None, "title": "Tile", "description": "", "link": {"external_link": "https://example.com"}}
+        self.render(blocks.LinkTile(), tile)
+        self.render(ContextLinkTile(), tile)
+        self.assertEqual(self.render_to_string.call_count, 2)
+
+    def test_context_keys_are_part_of_key(self):
+        block = ContextLinkTile()
+        tile = {"image": None, "title": "Tile", "description": "", "link": {"external_link": "https://example.com"}}
+        self.render(block, tile, {"link_class": "primary"})
+        self.render(block, tile, {"link_class": "primary", "page": "ignored"})
+        self.render(block, tile, {"link_class": "secondary"})
+        self.assertEqual(self.render_to_string.call_count, 2)
+
+    def test_preview_is_not_cached(self):
+        block = blocks.SideBarLink()
+        request = RequestFactory().get("/")
+        request.is_preview = True
+        self.render(block, context={"request": request})
+        self.render(block, context={"request": request})
+        self.assertEqual(self.render_to_string.call_count, 2)
+
+    def test_publish_clears_cache(self):
+        block = blocks.SideBarLink()
+        self.render(block)
+        page_published.send(sender=Page, instance=Page.get_first_root_node(), revision=None)
+        self.render(block)
+        self.assertEqual(self.render_to_string.call_count, 2)
+
+    def test_document_change_clears_cache(self):
+        block = blocks.SideBarLink()
+        self.render(block)
+        document = Document.objects.create(title="Document")
+        self.render(block)
+        document.title = "Renamed"
+        document.save()
+        self.render(block)
+        self.assertEqual(self.render_to_string.call_count, 3)
+
+    def test_image_change_clears_cache(self):
+        block = blocks.SideBarLink()
+        image = Image.objects.create(title="Image", file=get_test_image_file_png())
+        self.render(block)
+        image.delete()
+        self.render(block)
+        self.assertEqual(self.render_to_string.call_count, 2)
+
+    def test_context_dependent_blocks_are_not_cached(self):
+        # Both render CTAButtonBlock, whose template reads `link_class` from the context.
+        self.assertNotIsInstance(blocks.FullHeroBlock(), blocks.CachedRenderMixin)
+        self.assertNotIsInstance(blocks.ColumnatedLinksBlock(), blocks.CachedRenderMixin)
+
+
+class CheckTagOrderTest(TestCase):
+    """ check_tag_order agrees with the HTMLParser-based checker it replaced. """
+
+    # (html, error message, or None if valid), as reported by the old parser.
+    PARITY_CASES = [
+        ("", None),
+        ("plain text", None),
+        ("x < y and y > z", None),
+        ("<p>1 <2</p>", None),
+        ("a <b", None),
+        ("<p>x</p>", None),
+        ("<DIV></div>", None),
+        ("<p\n class='a'>\n</p>", None),
+        ("<p>x</p\n>", None),
+        ("<ul><li>1</li><li>2</li></ul>", None),
+        ("<my-el></my-el>", None),
+        ('<iframe width="560" src="https://www.youtube.com/embed/x" allowfullscreen></iframe>', None),
+        ('<div title="a > b"><p></p></div>', None),
+        ("<div title='a>b'></div>", None),
+        ('<a href="a"b>c</a>', None),
+        ('<a href="x/">y</a>', None),
+        ("<a href=http://x.com/>y</a>", None),
+        ("<br/>", None),
+        ("<p/>", None),
+        ("<div />", None),
+        ("<a b/>", None),
+        ('<svg><path d="M0"/></svg>', None),
+        ("<!DOCTYPE html><p></p>", None),
+        ("<div><!-- <p> --></div>", None),
+        ("<!-- <p>", None),
+        ("</</p>", None),
+        ("</>", None),
+        ("<p></p x>", None),
+        ("<script>if (a < b) {}</script>", None),
+        ('<script src="a.js"/><p></p>', None),
+        ("<style>p > a {}</STYLE><p></p>", None),
+        ("<div>", "Tag was not closed: div"),
+        ("<div><p>", "Tags were not closed: div, p"),
+        ("<P></<p>", "Tag was not closed: p"),
+        ("<a href=x?a=b/>", "Tag was not closed: a"),
+        ('<script>var a = "<b>";', "Tag was not closed: script"),
+        ("<p><b></p>", 'Unexpected closing tag on line 1 (6 offset): got "p", expected "b"'),
+        ("<div><span></div></span>", 'Unexpected closing tag on line 1 (11 offset): got "div", expected "span"'),
+        ("<div>\n  <span>\n</div>", 'Unexpected closing tag on line 3 (0 offset): got "div", expected "span"'),
+        ("<div class='a'>\n<p>\n</span>", 'Unexpected closing tag on line 3 (0 offset): got "span", expected "p"'),
+        ("</p>", IndexError),
+        ("</p >", IndexError),
+        ("</ p>", IndexError),
+        ("< div></div>", IndexError),
+    ]
+
+    def test_parity_with_html_parser(self):
+        for html, expected in self.PARITY_CASES:
+            with self.subTest(html=html):
+                if expected is None:
+                    blocks.check_tag_order(html)
+                elif expected is IndexError:
+                    with self.assertRaises(IndexError):
+                        blocks.check_tag_order(html)
+                else:
+                    with self.assertRaisesMessage(ValueError, expected):
+                        blocks.check_tag_order(html)
+
+    def test_differences_from_html_parser(self):
+        # The old parser wrongly required void elements to be closed, and popped them for
+        # </br>.
+        blocks.check_tag_order("<p>a<br>b</p>")
+        blocks.check_tag_order("<img src='a.png'>")
+        blocks.check_tag_order("<p></br></p>")
+        # A "<" inside an opening tag ends the tag rather than joining its name, which the
+        # old parser reported as "a<b".
+        with self.assertRaisesMessage(ValueError, "Tag was not closed: b"):
+            blocks.check_tag_order("<a<b>")
+
+    def test_unclosed_tags_scan_in_linear_time(self):
+        # Each of these took seconds to tens of seconds when every "<" scanned to the
+        # end of the input.
+        for html in ["<a " * 20000, "<script " * 4000, "<a" + "a" * 10000, '<a "' * 20000, "</a " * 20000]:
+            with self.subTest(html=html[:20]):
+                start = time.perf_counter()
+                blocks.check_tag_order(html)
+                self.assertLess(time.perf_counter() - start, 1)
+
+
+class ReorderableStructBlockTest(TestCase):
+    def test_field_order(self):
+        self.assertEqual(
+            list(blocks.FullHeroBlock().child_blocks),
+            ["image", "video_code", "heading", "heading_as_h1", "sub_heading", "cta_buttons"],
+        )
+
+    def test_field_order_moves_later_fields_first(self):
+        class OrderedBlock(blocks.ReorderableStructBlock):
+            first = wagtail_blocks.CharBlock()
+            second = wagtail_blocks.CharBlock()
+            third = wagtail_blocks.CharBlock()
+
+            class Meta:
+                field_order = ["third", "first"]
+
+        self.assertEqual(list(OrderedBlock().child_blocks), ["third", "first", "second"])
+
+    def test_local_blocks_follow_ordered_fields(self):
+        block = blocks.FullHeroBlock([("caption", wagtail_blocks.CharBlock())])
+        self.assertEqual(
+            list(block.child_blocks),
+            ["image", "video_code", "heading", "heading_as_h1", "sub_heading", "cta_buttons", "caption"],
+        )
+
+    def test_instance_field_order_can_name_local_blocks(self):
+        block = blocks.FullHeroBlock([("caption", wagtail_blocks.CharBlock())], field_order=["caption", "heading"])
+        self.assertEqual(
+            list(block.child_blocks),
+            ["caption", "heading", "image", "video_code", "heading_as_h1", "sub_heading", "cta_buttons"],
+        )
+        # Other instances keep the class order.
+        self.assertEqual(list(blocks.FullHeroBlock().child_blocks)[0], "image")
+
+    def test_unknown_field_raises_when_class_is_defined(self):
+        with self.assertRaisesMessage(ValueError, 'Unknown field "missing" found in BrokenBlock.meta.fields'):
+
+            class BrokenBlock(blocks.ReorderableStructBlock):
+                title = wagtail_blocks.CharBlock()
+
+                class Meta:
+                    field_order = ["title", "missing"]
+
+    def test_unknown_instance_field_raises(self):
+        with self.assertRaisesMessage(ValueError, 'Unknown field "missing" found in FullHeroBlock.meta.fields'):
+            blocks.FullHeroBlock(field_order=["missing"])
+
+
+class FullHeroBlockCleanTest(TestCase):
+    def setUp(self):
+        self.block = blocks.FullHeroBlock()
+        self.image = Image.objects.create(title="Hero", file=get_test_image_file_png())
+
+    def clean(self, **values):
+        raw = {"image": self.image.pk, "heading": "Heading", "video_code": "", **values}
+        return self.block.clean(self.block.to_python(raw))
+
+    def test_accepts_iframe_embed(self):
+        video_code = '<iframe width="560" src="https://www.youtube.com/embed/x" allowfullscreen></iframe>'
+        self.assertEqual(self.clean(video_code=video_code)["video_code"], video_code)
+
+    def test_rejects_unclosed_tag_on_video_code(self):
+        with self.assertRaises(StructBlockValidationError) as context:
+            self.clean(video_code="<div>")
+        self.assertEqual(list(context.exception.block_errors), ["video_code"])
+        self.assertEqual(context.exception.block_errors["video_code"].as_data()[0].message, "Tag was not closed: div")
+
+    def test_reports_video_code_with_other_field_errors(self):
+        with self.assertRaises(StructBlockValidationError) as context:
+            self.clean(video_code="<div>", heading="")
+        self.assertEqual(set(context.exception.block_errors), {"heading", "video_code"})
+
+
+class LinkBlockCleanTest(TestCase):
+    def test_link_types(self):
+        self.assertEqual(blocks.CTAButtonBlock().link_types, ("internal_link", "document_link", "external_link"))
+
+    def test_only_one_link_type(self):
+        block = blocks.CTAButtonBlock()
+        value = block.to_python({"display_text": "Link", "external_link": "https://example.com"})
+        value["internal_link"] = Page.get_first_root_node()
+        with self.assertRaises(ValidationError) as context:
+            block.clean(value)
+        self.assertEqual(set(context.exception.params), {"internal_link", "external_link"})
+
+    def test_exactly_one_link_type(self):
+        block = blocks.LinkWithoutTextBase()
+        with self.assertRaises(ValidationError) as context:
+            block.clean(block.to_python({}))
+        self.assertEqual(set(context.exception.params), set(block.link_types))